@@ -1,88 +1,484 @@
 import sqlite3
-import json
-import hashlib
-from flask import Flask, request, jsonify
+import orjson
+import zstandard
+import math
+import multiprocessing
+import re
+import os
+import threading
+import time
+from flask import Flask, request, jsonify, g, Response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pacsv
 import io
 import base64
 from datetime import datetime
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from uuid import uuid4
+import zipfile
+from xml.sax.saxutils import escape
 
 # --- INICIALIZAÇÃO DO APP ---
+# datetime/date/time ficam com o conversor padrão do Flask (formato HTTP), como antes do orjson
+ORJSON_OPCOES = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME
+
+# JSON das requisições e respostas via orjson; tipos que ele não conhece (datas do pandas etc.)
+# caem no conversor padrão do Flask
+class ORJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=ORJSON_OPCOES).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)
 
 CORS(app, resources={r"/api/*": {"origins": ["https://site.suporteverde.com.br", "http://localhost:5173"]}})
 
 DB_NAME = "sistema_notas_v2.db"
 
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# A partir de quantas linhas a geração das notas é dividida entre processos
+MIN_LINHAS_PARALELO = 500
+
+# Paginação da listagem de notas
+LIMITE_PADRAO = 100
+LIMITE_MAXIMO = 500
+
+# Nível do zstd para os detalhes das notas (3 é o padrão: boa taxa sem custar CPU no POST)
+NIVEL_ZSTD = 3
+
 # --- 1. CONFIGURAÇÃO DO BANCO DE DADOS ---
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    # Cria a tabela com ID Auto Incremental e Hash Único
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS notas (
+# Abre a conexão já com os PRAGMAs de desempenho (WAL evita o fsync do journal a cada commit)
+# isolation_level=None: sem transações implícitas, cada escrita em lote abre o próprio BEGIN/COMMIT.
+# cached_statements: mantém compilados os SQLs repetidos (o INSERT do lote, por exemplo)
+def get_conn():
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None, cached_statements=256)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
+# Chave de duplicidade das notas. No SQLite NULLs nunca são iguais entre si no índice único,
+# por isso os campos entram com coalesce
+CHAVE_NOTA = "coalesce(empresa, ''), coalesce(data, ''), coalesce(valor, '')"
+
+# Esquema da tabela de notas (usado também para recriá-la nas migrações)
+def criar_tabela_notas(cursor, tabela):
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {tabela} (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             empresa TEXT,
             data TEXT,
             valor TEXT,
             status TEXT,
             is_cadastrado INTEGER, 
-            arquivo_base64 TEXT,
-            detalhes_json TEXT,
-            hash_registro TEXT UNIQUE
+            arquivo BLOB,
+            detalhes_zstd BLOB
         )
     ''')
-    conn.commit()
+
+# Os detalhes ficam gravados como JSON comprimido com zstd.
+# As funções de módulo do zstandard são seguras entre threads, ao contrário de um ZstdCompressor compartilhado
+def compactar_detalhes(detalhes):
+    return zstandard.compress(orjson.dumps(detalhes), NIVEL_ZSTD)
+
+def ler_detalhes(blob):
+    return orjson.loads(zstandard.decompress(blob)) if blob else {}
+
+def init_db():
+    conn = get_conn()
+    cursor = conn.cursor()
+    # Cria a tabela com ID Auto Incremental
+    criar_tabela_notas(cursor, 'notas')
+    # Não precisa de índices extras: o id é o próprio rowid, então o ORDER BY id DESC
+    # percorre a tabela de trás pra frente sem ordenar
+
+    # Bancos antigos guardavam o arquivo em base64 (TEXT): migra para os bytes crus em BLOB
+    colunas = [c[1] for c in cursor.execute("PRAGMA table_info(notas)")]
+    if 'arquivo_base64' in colunas:
+        cursor.execute("BEGIN")
+        cursor.execute("ALTER TABLE notas ADD COLUMN arquivo BLOB")
+        cursor.execute("SELECT id, arquivo_base64 FROM notas WHERE arquivo_base64 IS NOT NULL")
+        migrados = [(base64.b64decode(b64), id) for id, b64 in cursor.fetchall()]
+        cursor.executemany("UPDATE notas SET arquivo = ? WHERE id = ?", migrados)
+        cursor.execute("ALTER TABLE notas DROP COLUMN arquivo_base64")
+        cursor.execute("COMMIT")
+
+    # Bancos antigos guardavam os detalhes como texto JSON: migra para o blob comprimido
+    colunas = [c[1] for c in cursor.execute("PRAGMA table_info(notas)")]
+    if 'detalhes_json' in colunas:
+        cursor.execute("BEGIN")
+        cursor.execute("ALTER TABLE notas ADD COLUMN detalhes_zstd BLOB")
+        cursor.execute("SELECT id, detalhes_json FROM notas WHERE detalhes_json IS NOT NULL")
+        migrados = [(compactar_detalhes(orjson.loads(texto)), id) for id, texto in cursor.fetchall()]
+        cursor.executemany("UPDATE notas SET detalhes_zstd = ? WHERE id = ?", migrados)
+        cursor.execute("ALTER TABLE notas DROP COLUMN detalhes_json")
+        cursor.execute("COMMIT")
+
+    # Bancos antigos deduplicavam por um hash MD5 na coluna hash_registro (UNIQUE).
+    # Coluna UNIQUE não pode ser removida com DROP COLUMN, então a tabela é recriada mantendo os ids.
+    colunas = [c[1] for c in cursor.execute("PRAGMA table_info(notas)")]
+    if 'hash_registro' in colunas:
+        cursor.execute("BEGIN")
+        criar_tabela_notas(cursor, 'notas_nova')
+        cursor.execute(f"CREATE UNIQUE INDEX uq_nota ON notas_nova({CHAVE_NOTA})")
+        # Notas que o hash separava podem colidir na chave nova (empresa nula x vazia, por exemplo).
+        # Fica uma por chave: a já cadastrada, senão a mais antiga
+        cursor.execute('''
+            INSERT OR IGNORE INTO notas_nova (id, empresa, data, valor, status, is_cadastrado, arquivo, detalhes_zstd)
+            SELECT id, empresa, data, valor, status, is_cadastrado, arquivo, detalhes_zstd FROM notas
+            ORDER BY is_cadastrado DESC, id
+        ''')
+        total = cursor.execute("SELECT COUNT(*) FROM notas").fetchone()[0]
+        repetidas = total - cursor.execute("SELECT COUNT(*) FROM notas_nova").fetchone()[0]
+        if repetidas > 0:
+            print(f"Migração: {repetidas} notas repetidas pela chave (empresa, data, valor) foram descartadas")
+        cursor.execute("DROP TABLE notas")
+        cursor.execute("ALTER TABLE notas_nova RENAME TO notas")
+        cursor.execute("COMMIT")
+
+    # A duplicidade é barrada pelo próprio índice único (o INSERT OR IGNORE pula as repetidas)
+    cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_nota ON notas({CHAVE_NOTA})")
     conn.close()
 
-# Inicializa o banco ao rodar o script
-init_db()
+# Uma conexão por requisição, reaproveitada por todas as consultas da rota
+def get_db():
+    if 'db' not in g:
+        g.db = get_conn()
+        g.db.row_factory = sqlite3.Row
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exception):
+    db = g.pop('db', None)
+    if db is not None:
+        db.close()
+
+# Inicializa o banco ao rodar o script. Os processos do pool importam este módulo de novo
+# para achar montar_nota; só o processo principal mexe no banco
+if multiprocessing.current_process().name == 'MainProcess':
+    init_db()
 
 # --- FUNÇÕES AUXILIARES ---
+# Tira o separador de milhar e troca a vírgula decimal por ponto numa passada só
+_TABELA_MOEDA = str.maketrans({'.': None, ',': '.'})
+
+# Normaliza nomes de coluna ("Resp. Fin" -> "respfin") para a busca do nome do cliente
+_TABELA_NOME_COLUNA = str.maketrans('', '', '. ')
+NOMES_PARECIDOS = frozenset(['respfin', 'nome', 'cliente', 'razaosocial'])
+
 def limpar_moeda(valor):
+    # Célula vazia (None ou NaN do pandas) vale zero
+    if valor is None or (isinstance(valor, float) and math.isnan(valor)):
+        return 0.0
     if isinstance(valor, (int, float)):
         return valor
     try:
-        return float(str(valor).replace('R$', '').replace('.', '').replace(',', '.').strip())
+        # float() já ignora espaços nas pontas
+        return float(str(valor).replace('R$', '').translate(_TABELA_MOEDA))
     except:
         return 0.0
     
-# Gera um ID único baseado no conteúdo para evitar duplicatas
-def gerar_hash(empresa, data, valor):
-    raw = f"{empresa}-{data}-{valor}"
-    return hashlib.md5(raw.encode('utf-8')).hexdigest()
+# Limpa uma coluna de moeda inteira de uma vez (colunas numéricas já vêm prontas)
+def valores_moeda(df, coluna):
+    if coluna not in df.columns:
+        return pd.Series(0, index=df.index)
+    if pd.api.types.is_numeric_dtype(df[coluna]):
+        return df[coluna].fillna(0)
+    return df[coluna].map(limpar_moeda)
+
+# Nomeia as colunas como o pandas faz: cabeçalho vazio vira "Unnamed: i" e nomes repetidos
+# ganham .1, .2... (pulando os sufixos que já existem no cabeçalho)
+def nomes_colunas(cabecalho):
+    nomes = [f'Unnamed: {i}' if nome is None or nome == '' else nome for i, nome in enumerate(cabecalho)]
+    contagem = {}
+    for i, nome in enumerate(nomes):
+        original = nome
+        atual = contagem.get(nome, 0)
+        while atual > 0:
+            contagem[original] = atual + 1
+            nome = f'{original}.{atual}'
+            atual = atual + 1 if nome in nomes else contagem.get(nome, 0)
+        nomes[i] = nome
+        contagem[nome] = atual + 1
+    return nomes
+
+# Lê um CSV com o leitor do pyarrow (multi-thread, em C++) e devolve um DataFrame do pandas
+def ler_csv(dados, encoding, separador):
+    tabela = pacsv.read_csv(
+        io.BytesIO(dados),
+        read_options=pacsv.ReadOptions(encoding=encoding),
+        parse_options=pacsv.ParseOptions(delimiter=separador),
+        # Conversões iguais às do pandas: célula vazia vira nulo, datas continuam texto
+        # (o formato vazio nunca casa, e lista vazia ativaria o parser ISO-8601 padrão)
+        # e só True/False (não 0/1) viram booleano
+        convert_options=pacsv.ConvertOptions(
+            strings_can_be_null=True,
+            timestamp_parsers=[''],
+            true_values=['True', 'TRUE', 'true'],
+            false_values=['False', 'FALSE', 'false']
+        )
+    )
+    # Texto inválido no encoding não gera erro no pyarrow, a coluna só vira binária.
+    # O pandas falhava aqui, e é essa falha que faz o processamento tentar latin1 com ';'
+    for campo in tabela.schema:
+        if pa.types.is_binary(campo.type):
+            raise UnicodeDecodeError(encoding, b'', 0, 0, f"coluna '{campo.name}' não está em {encoding}")
+    tabela = tabela.rename_columns(nomes_colunas(tabela.column_names))
+    # Coluna toda vazia chega sem tipo (null); o pandas a lia como float, cheia de NaN
+    for i, campo in enumerate(tabela.schema):
+        if pa.types.is_null(campo.type):
+            tabela = tabela.set_column(i, campo.name, tabela.column(i).cast(pa.float64()))
+    df = tabela.to_pandas(split_blocks=True, self_destruct=True)
+    # Texto nulo chega como None; o pandas usava NaN
+    return df.fillna(np.nan)
+
+# Lê o XLSX com o calamine (leitor em Rust); sem ele instalado, cai no openpyxl em modo
+# somente leitura, que percorre as linhas sem montar o modelo inteiro da planilha na memória.
+# Os dois passam pelo mesmo parser do pandas, então o DataFrame sai igual (cabeçalho, vazios, linhas em branco)
+def ler_excel(dados):
+    try:
+        return pd.read_excel(io.BytesIO(dados), engine='calamine')
+    except ImportError:
+        return pd.read_excel(io.BytesIO(dados), engine='openpyxl',
+                             engine_kwargs={'read_only': True, 'data_only': True})
+
+# Formata uma coluna de valores no padrão brasileiro (R$ 1.234,56) de uma vez só:
+# o formato do Python sai como 1,234.56 e os separadores são trocados com um marcador no meio
+def formatar_moeda(valores):
+    return (valores.map("R$ {:,.2f}".format).astype(str)
+            .str.replace(',', '|', regex=False)
+            .str.replace('.', ',', regex=False)
+            .str.replace('|', '.', regex=False))
+
+# Valores de uma coluna como lista (ou o valor padrão repetido, se a coluna não existir)
+def valores_coluna(df, coluna, padrao):
+    if coluna in df.columns:
+        return df[coluna].tolist()
+    return [padrao] * len(df)
+
+# Data de emissão de cada linha conforme o modo escolhido ('atual', 'venda', 'escolher')
+def datas_emissao(df, modo_data, data_custom):
+    data_emissao = datetime.now().strftime("%d/%m/%Y") # Padrão
+
+    if modo_data == 'escolher' and data_custom:
+        # Converte YYYY-MM-DD para DD/MM/YYYY
+        try:
+            data_obj = datetime.strptime(data_custom, '%Y-%m-%d')
+            data_emissao = data_obj.strftime("%d/%m/%Y")
+        except:
+            pass
+    elif modo_data == 'venda' and 'Data' in df.columns:
+        # Tenta pegar da planilha
+        datas = df['Data']
+        # Coluna de datas do pandas/excel: formata tudo de uma vez
+        if pd.api.types.is_datetime64_any_dtype(datas):
+            return datas.dt.strftime("%d/%m/%Y").fillna(data_emissao).tolist()
+        return [
+            (d.strftime("%d/%m/%Y") if isinstance(d, datetime) else str(d)) if pd.notna(d) else data_emissao
+            for d in datas
+        ]
+
+    return [data_emissao] * len(df)
+
+# Para cada linha, pega o valor da primeira coluna (na ordem dada) que estiver preenchida
+def primeiro_preenchido(df, colunas):
+    serie = pd.Series(None, index=df.index, dtype=object)
+    for col in colunas:
+        serie = serie.where(serie.notna(), df[col])
+    return serie
+
+# --- MODELO DA NOTA EM EXCEL ---
+# O layout da nota é fixo, então o .xlsx é montado direto com zipfile a partir de XMLs prontos:
+# só a planilha muda por nota, e só nas células dinâmicas.
+_XML_HEADER = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+_XLSX_PARTES_FIXAS = [
+    ('[Content_Types].xml', _XML_HEADER +
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'),
+    ('_rels/.rels', _XML_HEADER +
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'),
+    ('xl/workbook.xml', _XML_HEADER +
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Nota Fiscal" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'),
+    ('xl/_rels/workbook.xml.rels', _XML_HEADER +
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>'),
+    # Estilos (índice em cellXfs): 1 título, 2 negrito, 3 título de seção, 4 cabeçalho da tabela,
+    # 5 linha de valores, 6 linha de valores em R$, 7 valor líquido
+    ('xl/styles.xml', _XML_HEADER +
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<numFmts count="1"><numFmt numFmtId="164" formatCode="R$ #,##0.00"/></numFmts>'
+        '<fonts count="5">'
+        '<font><sz val="11"/><name val="Calibri"/><family val="2"/></font>'
+        '<font><b val="1"/><color rgb="00FFFFFF"/><sz val="14"/></font>'
+        '<font><b val="1"/></font>'
+        '<font><b val="1"/><color rgb="002C5282"/></font>'
+        '<font><b val="1"/><sz val="12"/></font>'
+        '</fonts>'
+        '<fills count="3">'
+        '<fill><patternFill/></fill>'
+        '<fill><patternFill patternType="gray125"/></fill>'
+        '<fill><patternFill patternType="solid"><fgColor rgb="002C5282"/><bgColor rgb="002C5282"/></patternFill></fill>'
+        '</fills>'
+        '<borders count="3">'
+        '<border><left/><right/><top/><bottom/><diagonal/></border>'
+        '<border><bottom style="thick"><color rgb="002C5282"/></bottom></border>'
+        '<border><left style="thin"/><right style="thin"/><top style="thin"/><bottom style="thin"/></border>'
+        '</borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="8">'
+        '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="0" fontId="1" fillId="2" borderId="0" applyAlignment="1" xfId="0"><alignment horizontal="center" vertical="center"/></xf>'
+        '<xf numFmtId="0" fontId="2" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="0" fontId="3" fillId="0" borderId="1" xfId="0"/>'
+        '<xf numFmtId="0" fontId="2" fillId="0" borderId="2" applyAlignment="1" xfId="0"><alignment horizontal="center" vertical="center"/></xf>'
+        '<xf numFmtId="0" fontId="0" fillId="0" borderId="2" applyAlignment="1" xfId="0"><alignment horizontal="center"/></xf>'
+        '<xf numFmtId="164" fontId="0" fillId="0" borderId="2" applyAlignment="1" xfId="0"><alignment horizontal="center"/></xf>'
+        '<xf numFmtId="164" fontId="4" fillId="0" borderId="0" xfId="0"/>'
+        '</cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'),
+]
+
+# Planilha da nota: cada {campo} recebe uma célula inteira gerada por _celula_xml
+_XLSX_SHEET = (_XML_HEADER +
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<dimension ref="A1:D17"/>'
+    '<cols>'
+    '<col min="1" max="1" width="30" customWidth="1"/>'
+    '<col min="2" max="2" width="25" customWidth="1"/>'
+    '<col min="3" max="3" width="20" customWidth="1"/>'
+    '<col min="4" max="4" width="20" customWidth="1"/>'
+    '</cols>'
+    '<sheetData>'
+    '<row r="1"><c r="A1" s="1" t="inlineStr"><is><t>MD SISTEMAS - NOTA FISCAL DE SERVIÇO</t></is></c></row>'
+    '<row r="4"><c r="A4" s="2" t="inlineStr"><is><t>Número da Nota:</t></is></c>{num}'
+    '<c r="C4" s="2" t="inlineStr"><is><t>Data Emissão:</t></is></c>{data_emissao}</row>'
+    '<row r="6"><c r="A6" s="3" t="inlineStr"><is><t>DADOS DO TOMADOR DE SERVIÇO</t></is></c></row>'
+    '<row r="8"><c r="A8" t="inlineStr"><is><t>Razão Social / Nome:</t></is></c>{nome}</row>'
+    '<row r="9"><c r="A9" t="inlineStr"><is><t>CPF / CNPJ:</t></is></c>{cpf}</row>'
+    '<row r="10"><c r="A10" t="inlineStr"><is><t>Origem:</t></is></c>{origem}</row>'
+    '<row r="12"><c r="A12" s="3" t="inlineStr"><is><t>DETALHES DO PAGAMENTO</t></is></c></row>'
+    '<row r="14">'
+    '<c r="A14" s="4" t="inlineStr"><is><t>Descrição (Espécie)</t></is></c>'
+    '<c r="B14" s="4" t="inlineStr"><is><t>Vencimento</t></is></c>'
+    '<c r="C14" s="4" t="inlineStr"><is><t>Desconto</t></is></c>'
+    '<c r="D14" s="4" t="inlineStr"><is><t>Valor Total</t></is></c>'
+    '</row>'
+    '<row r="15">{descricao}{venc}{v_desc}{v_devido}</row>'
+    '<row r="17"><c r="C17" s="2" t="inlineStr"><is><t>VALOR LÍQUIDO:</t></is></c>{v_liquido}</row>'
+    '</sheetData>'
+    '<mergeCells count="3"><mergeCell ref="A1:D2"/><mergeCell ref="A6:D6"/><mergeCell ref="A12:D12"/></mergeCells>'
+    '</worksheet>')
+
+# Gera o XML de uma célula conforme o tipo do valor (vazio, booleano, número ou texto)
+# Caracteres de controle que o XML não aceita nem escapados (os mesmos que o openpyxl recusa)
+_CARACTERES_ILEGAIS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def _celula_xml(ref, valor, estilo=0):
+    s = f' s="{estilo}"' if estilo else ''
+    if valor is None or (isinstance(valor, float) and not math.isfinite(valor)):
+        return f'<c r="{ref}"{s}/>'
+    if isinstance(valor, bool):
+        return f'<c r="{ref}"{s} t="b"><v>{int(valor)}</v></c>'
+    if isinstance(valor, (int, float)):
+        if isinstance(valor, float) and valor.is_integer():
+            valor = int(valor)
+        return f'<c r="{ref}"{s} t="n"><v>{valor}</v></c>'
+    texto = escape(_CARACTERES_ILEGAIS.sub('', str(valor)))
+    return f'<c r="{ref}"{s} t="inlineStr"><is><t xml:space="preserve">{texto}</t></is></c>'
+
+# Monta o .xlsx de uma nota e devolve os bytes do arquivo
+def montar_xlsx_nota(campos):
+    sheet = _XLSX_SHEET.format_map(campos)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        for nome, conteudo in _XLSX_PARTES_FIXAS:
+            zf.writestr(nome, conteudo)
+        zf.writestr('xl/worksheets/sheet1.xml', sheet)
+    return buffer.getvalue()
 
 # --- 2. ROTAS DE BANCO DE DADOS ---
 
-# Rota para LISTAR todas as notas salvas (GET)
+# Rota para LISTAR as notas salvas (GET), paginada por id: ?before=<id>&limit=<n>
+# O arquivo fica de fora da listagem e é buscado em /api/notas/<id>/arquivo
 @app.route('/api/notas', methods=['GET'])
 def get_notas():
     try:
-        conn = sqlite3.connect(DB_NAME)
-        conn.row_factory = sqlite3.Row
+        before = request.args.get('before', type=int)
+        # Limitado dos dois lados: no SQLite um LIMIT negativo significa "sem limite"
+        limit = max(1, min(request.args.get('limit', LIMITE_PADRAO, type=int), LIMITE_MAXIMO))
+
+        conn = get_db()
         cursor = conn.cursor()
         
-        cursor.execute("SELECT * FROM notas ORDER BY id DESC") # Mais recentes primeiro
+        colunas = "SELECT id, empresa, data, valor, status, is_cadastrado, detalhes_zstd FROM notas"
+        if before is None:
+            cursor.execute(f"{colunas} ORDER BY id DESC LIMIT ?", (limit,)) # Mais recentes primeiro
+        else:
+            cursor.execute(f"{colunas} WHERE id < ? ORDER BY id DESC LIMIT ?", (before, limit))
+        # A página já é limitada; busca tudo antes, pois a conexão de g fecha ao fim da rota
         rows = cursor.fetchall()
-        
-        notas = []
-        for row in rows:
-            notas.append({
-                "id": row["id"], # ID Incremental do SQLite
-                "empresa": row["empresa"],
-                "data": row["data"],
-                "valor": row["valor"],
-                "status": row["status"],
-                "isCadastrado": bool(row["is_cadastrado"]),
-                "arquivoBase64": row["arquivo_base64"],
-                "detalhesCompletos": json.loads(row["detalhes_json"]) if row["detalhes_json"] else {}
-            })
-        conn.close()
-        return jsonify(notas)
+
+        # Escreve o array JSON aos poucos, sem montar a lista inteira em memória
+        def generate():
+            yield b'['
+            for i, row in enumerate(rows):
+                if i > 0:
+                    yield b','
+                yield orjson.dumps({
+                    "id": row["id"], # ID Incremental do SQLite
+                    "empresa": row["empresa"],
+                    "data": row["data"],
+                    "valor": row["valor"],
+                    "status": row["status"],
+                    "isCadastrado": bool(row["is_cadastrado"]),
+                    "detalhesCompletos": ler_detalhes(row["detalhes_zstd"])
+                })
+            yield b']'
+
+        return Response(generate(), mimetype='application/json')
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Rota para BAIXAR o arquivo de uma nota (GET)
+@app.route('/api/notas/<int:id>/arquivo', methods=['GET'])
+def get_nota_arquivo(id):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT arquivo FROM notas WHERE id = ?", (id,))
+        row = cursor.fetchone()
+        if row is None or row["arquivo"] is None:
+            return jsonify({'error': 'Nota não encontrada'}), 404
+        return Response(
+            row["arquivo"],
+            mimetype=XLSX_MIMETYPE,
+            headers={'Content-Disposition': f'attachment; filename="nota-{id}.xlsx"'}
+        )
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -91,41 +487,47 @@ def get_notas():
 def save_notas():
     try:
         novas_notas = request.json
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_db()
         cursor = conn.cursor()
 
-        salvas = 0
-        ignoradas = 0
-
-        for nota in novas_notas:
-            # Gera o hash para verificação de duplicidade
-            rec_hash = gerar_hash(nota['empresa'], nota['data'], nota['valor'])
-            
-            # Verifica se já existe
-            cursor.execute("SELECT id FROM notas WHERE hash_registro = ?", (rec_hash,))
-            if cursor.fetchone() is None:
-                cursor.execute('''
-                    INSERT INTO notas (empresa, data, valor, status, is_cadastrado, arquivo_base64, detalhes_json, hash_registro)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    nota['empresa'], nota['data'], nota['valor'], nota['status'],
-                    1 if nota['isCadastrado'] else 0,
-                    nota['arquivoBase64'],
-                    json.dumps(nota['detalhesCompletos']),
-                    rec_hash
-                ))
-                salvas += 1
-            else:
-                ignoradas += 1
-        
-        conn.commit()
-        conn.close()
+        # Monta todas as linhas de uma vez; a duplicidade fica a cargo do índice único em (empresa, data, valor)
+        registros = [
+            (
+                nota['empresa'], nota['data'], nota['valor'], nota['status'],
+                1 if nota['isCadastrado'] else 0,
+                base64.b64decode(nota['arquivoBase64']), # Guardado como bytes crus (BLOB)
+                compactar_detalhes(nota['detalhesCompletos'])
+            )
+            for nota in novas_notas
+        ]
+
+        # Uma única transação para todo o lote. O RETURNING devolve o id de cada nota inserida
+        # (as duplicatas ignoradas não devolvem nada); o executemany descarta essas linhas,
+        # por isso o INSERT roda um a um, reaproveitando o mesmo statement compilado
+        sql = '''
+            INSERT OR IGNORE INTO notas (empresa, data, valor, status, is_cadastrado, arquivo, detalhes_zstd)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            RETURNING id
+        '''
+        ids = []
+        cursor.execute("BEGIN")
+        try:
+            for registro in registros:
+                linha = cursor.execute(sql, registro).fetchone()
+                if linha is not None:
+                    ids.append(linha[0])
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        salvas = len(ids)
+        ignoradas = len(registros) - salvas
         
         msg = f"{salvas} notas salvas."
         if ignoradas > 0:
             msg += f" ({ignoradas} duplicatas já existiam)"
 
-        return jsonify({"message": msg, "duplicates": ignoradas}), 201
+        return jsonify({"message": msg, "duplicates": ignoradas, "ids": ids}), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -134,17 +536,142 @@ def save_notas():
 def update_nota(id):
     try:
         dados = request.json
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_db()
         cursor = conn.cursor()
+        # Em autocommit o UPDATE já é gravado sozinho
         cursor.execute('UPDATE notas SET is_cadastrado = ? WHERE id = ?', (1 if dados['isCadastrado'] else 0, id))
-        conn.commit()
-        conn.close()
         return jsonify({"message": "Status atualizado!"})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 # --- 3. ROTA DE PROCESSAMENTO (ATUALIZADA COM LÓGICA DE DATA) ---
+# Monta os dados e o arquivo de uma nota a partir dos valores já resolvidos de uma linha da planilha.
+# Fica no topo do módulo para poder ser enviada aos processos do pool.
+def montar_nota(index, nome_cliente, val_devido, val_desc, fmt_devido, fmt_receb, fmt_desc, data_emissao,
+                origem, cpf, titulo, especie, p_contas, cpf_resp, venc, descricao):
+    # Dados para o Frontend
+    item_dados = {
+        'temp_id': index,  # Usamos temp_id pois ainda não foi pro banco
+        'nome_arquivo': f"NF-{1000+index} - {str(nome_cliente)[:30]}",
+        'respFin': nome_cliente,
+        'origem': origem,
+        'cpf': cpf,
+        'titulo': titulo,
+        'especie': especie,
+        'vDevido': fmt_devido,
+        'vReceb': fmt_receb,
+        'vDesc': fmt_desc,
+        'pContas': p_contas,
+        'cpfResp': cpf_resp,
+        'data': data_emissao, # Usa a data calculada para a linha
+        'venc': venc,
+        'arquivo': '' 
+    }
+
+    # Montagem do Excel (Visual): a parte fixa já está no modelo, só as células dinâmicas mudam
+    arquivo = montar_xlsx_nota({
+        'num': _celula_xml('B4', 1000 + index),
+        'data_emissao': _celula_xml('D4', data_emissao), # Data dinâmica no Excel
+        'nome': _celula_xml('B8', nome_cliente),
+        'cpf': _celula_xml('B9', item_dados['cpf']),
+        'origem': _celula_xml('B10', item_dados['origem']),
+        'descricao': _celula_xml('A15', descricao, 5),
+        'venc': _celula_xml('B15', item_dados['venc'], 5),
+        'v_desc': _celula_xml('C15', val_desc, 6),
+        'v_devido': _celula_xml('D15', val_devido, 6),
+        'v_liquido': _celula_xml('D17', val_devido - val_desc, 7),
+    })
+
+    item_dados['arquivo'] = base64.b64encode(arquivo).decode('utf-8')
+    return item_dados
+
+# Pool de processos criado sob demanda e reaproveitado entre requisições.
+# Os processos saem de um forkserver: fazer fork() direto de uma thread de job, com as outras
+# threads e o pool de threads do pyarrow rodando, pode herdar locks presos e travar o filho
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                        mp_context=multiprocessing.get_context('forkserver'))
+    return _pool
+
+# Processamento completo de uma planilha; roda nas threads de background, fora da requisição
+def processar_planilha(dados, nome_arquivo, modo_data, data_custom):
+    # Leitura do arquivo
+    if nome_arquivo.endswith('.csv'):
+        try:
+            df = ler_csv(dados, 'utf-8', ',')
+        except:
+            df = ler_csv(dados, 'latin1', ';')
+    else:
+        df = ler_excel(dados)
+
+    df.columns = df.columns.str.strip()
+
+    # --- COLUNAS PRÉ-CALCULADAS (uma vez por planilha, não por linha) ---
+    # Lógica de Busca de Nome: primeiro as colunas conhecidas, depois qualquer coluna parecida
+    buscas = ['Resp. Fin', 'Resp Fin', 'Resp. Fin.', 'Nome', 'Cliente', 'Razão Social']
+    nomes = primeiro_preenchido(df, [b for b in buscas if b in df.columns]).fillna('Consumidor')
+    parecidas = [col for col in df.columns if col.lower().translate(_TABELA_NOME_COLUNA) in NOMES_PARECIDOS]
+    sem_nome = nomes == 'Consumidor'
+    nomes = nomes.where(~sem_nome, primeiro_preenchido(df, parecidas).fillna('Consumidor'))
+
+    valores_devido = valores_moeda(df, 'V. Devido')
+    valores_receb = valores_moeda(df, 'V. Receb')
+    valores_desc = valores_moeda(df, 'V. Desc')
+
+    # Demais campos: cada coluna é procurada uma vez só, com o mesmo valor padrão de antes
+    hoje = datetime.now().strftime("%d/%m/%Y")
+    cpfs = [a or b or '-' for a, b in zip(valores_coluna(df, 'CPF/CNPJ', None), valores_coluna(df, 'CPF', None))]
+    if 'CPF Resp' in df.columns:
+        cpfs_resp = valores_coluna(df, 'CPF Resp', '-')
+    else:
+        cpfs_resp = valores_coluna(df, 'CPF/CNPJ', '-')
+    descricoes = [f"{e} - {t}" for e, t in zip(valores_coluna(df, 'Espécie', 'Serviço'), valores_coluna(df, 'Título', ''))]
+
+    colunas = (df.index, nomes.tolist(),
+               valores_devido.tolist(), valores_desc.tolist(),
+               formatar_moeda(valores_devido).tolist(),
+               formatar_moeda(valores_receb).tolist(),
+               formatar_moeda(valores_desc).tolist(),
+               datas_emissao(df, modo_data, data_custom),
+               valores_coluna(df, 'Origem', '-'),
+               cpfs,
+               valores_coluna(df, 'Título', 'Serviço'),
+               valores_coluna(df, 'Espécie', 'NF-e'),
+               valores_coluna(df, 'P. Contas', 'Fidelizado'),
+               cpfs_resp,
+               [str(v) for v in valores_coluna(df, 'Venc', hoje)],
+               descricoes)
+
+    # Planilhas pequenas não compensam o custo de mandar as linhas para outros processos
+    if len(df) >= MIN_LINHAS_PARALELO:
+        return list(get_pool().map(montar_nota, *colunas, chunksize=32))
+    return list(map(montar_nota, *colunas))
+
+# Jobs de processamento em andamento: job_id -> Future
+# (ficam na memória do processo; o resultado é liberado assim que entregue)
+executor_jobs = ThreadPoolExecutor(max_workers=4)
+JOBS = {}
+_jobs_lock = threading.Lock()
+
+# Resultado que ninguém buscou é descartado este tempo (em segundos) depois de pronto,
+# senão cliente que sai da página deixa todas as planilhas geradas na memória
+JOB_TTL = 10 * 60
+
+def limpar_jobs():
+    limite = time.monotonic() - JOB_TTL
+    with _jobs_lock:
+        vencidos = [job_id for job_id, job in JOBS.items() if job['fim'] is not None and job['fim'] < limite]
+        for job_id in vencidos:
+            del JOBS[job_id]
+
+# Rota que RECEBE a planilha e agenda o processamento (POST); o resultado sai em /api/jobs/<id>
 @app.route('/api/processar-notas', methods=['POST'])
 def processar_notas():
     try:
@@ -157,169 +684,45 @@ def processar_notas():
         modo_data = request.form.get('modoData', 'atual') # 'atual', 'venda', 'escolher'
         data_custom = request.form.get('dataCustom', '')
 
-        # Leitura do arquivo
-        if file.filename.endswith('.csv'):
-            try:
-                df = pd.read_csv(file, encoding='utf-8')
-            except:
-                file.seek(0)
-                df = pd.read_csv(file, encoding='latin1', sep=';')
-        else:
-            df = pd.read_excel(file)
+        # O arquivo é lido aqui, pois o upload deixa de existir quando a requisição termina
+        limpar_jobs()
+        job_id = uuid4().hex
+        future = executor_jobs.submit(processar_planilha, file.read(), file.filename, modo_data, data_custom)
+        job = {'future': future, 'fim': None}
+        with _jobs_lock:
+            JOBS[job_id] = job
+        future.add_done_callback(lambda _: job.update(fim=time.monotonic()))
 
-        df.columns = df.columns.str.strip()
-        
-        resultado_processamento = []
-
-        # Estilos Excel
-        estilo_titulo = Font(bold=True, size=14, color="FFFFFF")
-        fundo_azul = PatternFill(start_color="2C5282", end_color="2C5282", fill_type="solid")
-        estilo_negrito = Font(bold=True)
-        borda_fina = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-        alinhamento_centro = Alignment(horizontal='center', vertical='center')
-
-        for index, row in df.iterrows():
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "Nota Fiscal"
-
-            # --- DEFINIÇÃO DA DATA DE EMISSÃO ---
-            data_emissao = datetime.now().strftime("%d/%m/%Y") # Padrão
-            
-            if modo_data == 'escolher' and data_custom:
-                # Converte YYYY-MM-DD para DD/MM/YYYY
-                try:
-                    data_obj = datetime.strptime(data_custom, '%Y-%m-%d')
-                    data_emissao = data_obj.strftime("%d/%m/%Y")
-                except:
-                    pass
-            elif modo_data == 'venda':
-                # Tenta pegar da planilha
-                if 'Data' in df.columns and pd.notna(row['Data']):
-                    data_raw = row['Data']
-                    # Se for objeto datetime do pandas/excel
-                    if isinstance(data_raw, datetime):
-                        data_emissao = data_raw.strftime("%d/%m/%Y")
-                    else:
-                        data_emissao = str(data_raw)
-
-            # Lógica de Busca de Nome
-            nome_cliente = 'Consumidor'
-            buscas = ['Resp. Fin', 'Resp Fin', 'Resp. Fin.', 'Nome', 'Cliente', 'Razão Social']
-            for b in buscas:
-                if b in df.columns and pd.notna(row.get(b)):
-                    nome_cliente = row.get(b)
-                    break
-            
-            if nome_cliente == 'Consumidor':
-                for col in df.columns:
-                    limpa = col.lower().replace('.', '').replace(' ', '')
-                    if limpa in ['respfin', 'nome', 'cliente', 'razaosocial']:
-                        if pd.notna(row.get(col)):
-                            nome_cliente = row.get(col)
-                            break
-            
-            # Dados para o Frontend
-            val_devido = limpar_moeda(row.get('V. Devido', 0))
-            
-            item_dados = {
-                'temp_id': index,  # Usamos temp_id pois ainda não foi pro banco
-                'nome_arquivo': f"NF-{1000+index} - {str(nome_cliente)[:30]}",
-                'respFin': nome_cliente,
-                'origem': row.get('Origem', '-'),
-                'cpf': row.get('CPF/CNPJ') or row.get('CPF') or '-',
-                'titulo': row.get('Título', 'Serviço'),
-                'especie': row.get('Espécie', 'NF-e'),
-                'vDevido': f"R$ {val_devido:,.2f}".replace('.', ','),
-                'vReceb': f"R$ {limpar_moeda(row.get('V. Receb', 0)):,.2f}".replace('.', ','),
-                'vDesc': f"R$ {limpar_moeda(row.get('V. Desc', 0)):,.2f}".replace('.', ','),
-                'pContas': row.get('P. Contas', 'Fidelizado'),
-                'cpfResp': row.get('CPF Resp', row.get('CPF/CNPJ', '-')),
-                'data': data_emissao, # Usa a data calculada acima
-                'venc': str(row.get('Venc', datetime.now().strftime("%d/%m/%Y"))),
-                'arquivo': '' 
-            }
-
-            # Montagem do Excel (Visual)
-            ws.merge_cells('A1:D2')
-            cell = ws['A1']
-            cell.value = "MD SISTEMAS - NOTA FISCAL DE SERVIÇO"
-            cell.font = estilo_titulo
-            cell.fill = fundo_azul
-            cell.alignment = alinhamento_centro
-
-            ws['A4'] = "Número da Nota:"
-            ws['B4'] = 1000 + index
-            ws['C4'] = "Data Emissão:"
-            ws['D4'] = data_emissao # Data dinâmica no Excel
-            ws['A4'].font = ws['C4'].font = estilo_negrito
-
-            ws.merge_cells('A6:D6')
-            ws['A6'] = "DADOS DO TOMADOR DE SERVIÇO"
-            ws['A6'].font = Font(bold=True, color="2C5282")
-            ws['A6'].border = Border(bottom=Side(style='thick', color="2C5282"))
-
-            ws['A8'] = "Razão Social / Nome:"
-            ws['B8'] = nome_cliente
-            ws['A9'] = "CPF / CNPJ:"
-            ws['B9'] = item_dados['cpf']
-            ws['A10'] = "Origem:"
-            ws['B10'] = item_dados['origem']
-
-            ws.merge_cells('A12:D12')
-            ws['A12'] = "DETALHES DO PAGAMENTO"
-            ws['A12'].font = Font(bold=True, color="2C5282")
-            ws['A12'].border = Border(bottom=Side(style='thick', color="2C5282"))
-
-            headers = ["Descrição (Espécie)", "Vencimento", "Desconto", "Valor Total"]
-            col_letters = ['A', 'B', 'C', 'D']
-            for i, header in enumerate(headers):
-                cell = ws[f'{col_letters[i]}14']
-                cell.value = header
-                cell.font = estilo_negrito
-                cell.border = borda_fina
-                cell.alignment = alinhamento_centro
-
-            val_desc = limpar_moeda(row.get('V. Desc', 0))
-            descricao = f"{row.get('Espécie', 'Serviço')} - {row.get('Título', '')}"
-            
-            ws['A15'] = descricao
-            ws['B15'] = item_dados['venc']
-            ws['C15'] = val_desc
-            ws['D15'] = val_devido
-
-            ws['C15'].number_format = 'R$ #,##0.00'
-            ws['D15'].number_format = 'R$ #,##0.00'
-
-            for col in col_letters:
-                ws[f'{col}15'].border = borda_fina
-                ws[f'{col}15'].alignment = Alignment(horizontal='center')
-
-            ws['C17'] = "VALOR LÍQUIDO:"
-            ws['C17'].font = estilo_negrito
-            ws['D17'] = val_devido - val_desc
-            ws['D17'].number_format = 'R$ #,##0.00'
-            ws['D17'].font = Font(bold=True, size=12)
-
-            ws.column_dimensions['A'].width = 30
-            ws.column_dimensions['B'].width = 25
-            ws.column_dimensions['C'].width = 20
-            ws.column_dimensions['D'].width = 20
-
-            excel_buffer = io.BytesIO()
-            wb.save(excel_buffer)
-            excel_buffer.seek(0)
-            
-            arquivo_base64 = base64.b64encode(excel_buffer.getvalue()).decode('utf-8')
-            item_dados['arquivo'] = arquivo_base64
-            
-            resultado_processamento.append(item_dados)
-
-        return jsonify(resultado_processamento)
+        url = f"/api/jobs/{job_id}"
+        return jsonify({'job': job_id, 'status': 'pendente', 'url': url}), 202, {'Location': url}
 
     except Exception as e:
         print(f"Erro detalhado: {e}")
         return {'error': str(e)}, 500
 
+# Rota para ACOMPANHAR um processamento (GET)
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    limpar_jobs()
+    with _jobs_lock:
+        job = JOBS.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job não encontrado'}), 404
+
+    future = job['future']
+
+    if not future.done():
+        status = 'processando' if future.running() else 'pendente'
+        return jsonify({'job': job_id, 'status': status})
+
+    with _jobs_lock:
+        JOBS.pop(job_id, None)
+    erro = future.exception()
+    if erro is not None:
+        print(f"Erro detalhado: {erro}")
+        return jsonify({'job': job_id, 'status': 'erro', 'error': str(erro)}), 500
+
+    return jsonify({'job': job_id, 'status': 'concluido', 'resultado': future.result()})
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
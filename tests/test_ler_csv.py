@@ -0,0 +1,36 @@
+import importlib
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+RAIZ = Path(__file__).resolve().parent.parent
+FIXTURES = Path(__file__).resolve().parent / 'fixtures'
+
+def setUpModule():
+    # O app cria o banco no diretório atual ao ser importado
+    global app, _cwd, _tmp
+    _cwd = os.getcwd()
+    _tmp = tempfile.TemporaryDirectory()
+    os.chdir(_tmp.name)
+    sys.path.insert(0, str(RAIZ))
+    app = importlib.import_module('app')
+
+def tearDownModule():
+    os.chdir(_cwd)
+    _tmp.cleanup()
+
+class LerCsvTest(unittest.TestCase):
+    def test_latin1_com_ponto_e_virgula_cai_no_fallback(self):
+        dados = (FIXTURES / 'latin1_ponto_virgula.csv').read_bytes()
+        with self.assertRaises(UnicodeDecodeError):
+            app.ler_csv(dados, 'utf-8', ',')
+
+        notas = app.processar_planilha(dados, 'export.csv', 'atual', '')
+        self.assertEqual([n['respFin'] for n in notas], ['José', 'Conceição'])
+        self.assertEqual([n['origem'] for n in notas], ['Loja', 'Site'])
+        self.assertEqual([n['cpf'] for n in notas], [111, 222])
+
+if __name__ == '__main__':
+    unittest.main()